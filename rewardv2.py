@@ -1,6 +1,247 @@
+# cython: language_level=3, infer_types=True
+import hashlib
 import math
+import os
+import tempfile
+from operator import itemgetter
+
 import numpy as np
 
+DEFAULT_REWARD = 1.0
+LOWEST_REWARD = 1e-3
+DIRECTION_THRESHOLD = 8.0
+ABS_STEERING_THRESHOLD = 20.0
+# steering_angle is reported in degrees, these were tuned as 0.1 and 0.2 radians
+STRAIGHT_STEERING_THRESHOLD_1 = math.degrees(0.1)
+STRAIGHT_STEERING_THRESHOLD_2 = math.degrees(0.2)
+PROGRESS_THRESHOLD = 75
+REINFORCE_FACTOR_1 = 1.2
+REINFORCE_FACTOR_2 = 1.5
+REINFORCE_FACTOR_3 = 1.3
+REINFORCE_FACTOR_4 = 1.28
+PUNISH_FACTOR_1 = 0.8
+PUNISH_FACTOR_2 = 0.5
+PUNISH_FACTOR_3 = 0.6
+PUNISH_FACTOR_4 = 0.73
+COS_DIRECTION_THRESHOLD = math.cos(math.radians(DIRECTION_THRESHOLD))
+SPEED_UP_MIN_STEP = 3
+SPEED_UP_FUTURE_STEP = 8
+SPEED_UP_MIN_DISTANCE = 1.1
+
+# bump when the layout or meaning of the stored track tables changes
+_TRACK_TABLES_VERSION = 2
+
+_get_params = itemgetter('track_width', 'distance_from_center', 'is_left_of_center', 'all_wheels_on_track',
+                         'speed', 'waypoints', 'closest_waypoints', 'progress',
+                         'is_crashed', 'is_reversed', 'is_offtrack')
+
+# center distance markers, keyed by track_width
+_MARKERS = {}
+
+
+def _wrap180(degree):
+    # absolute angle difference folded into [0, 180]
+    return np.abs(((degree + 180) % 360) - 180)
+
+
+def _chord_degrees(wp, start, end):
+    d = wp[end] - wp[start]
+    return np.degrees(np.arctan2(d[:, 1], d[:, 0]))
+
+
+def build_speed_up_table(wp, min_step=SPEED_UP_MIN_STEP, future_step=SPEED_UP_FUTURE_STEP):
+    # whether the track ahead of each closest_waypoints[0] is straight enough to speed up,
+    # comparing the chord to the next waypoint with the chords to the look-ahead waypoints
+    n = len(wp)
+    last = n - 1
+    prev_idx = np.arange(n)
+    next_idx = (prev_idx + 1) % n
+    further = np.minimum(last, next_idx + future_step)
+    nearer = np.minimum(last, next_idx + min_step)
+
+    direction_degree = _chord_degrees(wp, prev_idx, next_idx)
+    diff_future = _wrap180(direction_degree - _chord_degrees(wp, prev_idx, further))
+    diff_min = _wrap180(direction_degree - _chord_degrees(wp, prev_idx, nearer))
+    d = wp[next_idx] - wp[further]
+    distance = np.hypot(d[:, 0], d[:, 1])
+
+    return (diff_future < DIRECTION_THRESHOLD) | ((distance >= SPEED_UP_MIN_DISTANCE) & (diff_min < DIRECTION_THRESHOLD))
+
+
+def build_track_tables(wp):
+    # unit vector of segment i, from waypoint i to i + 1, wrapping at the end of the lap
+    d = np.roll(wp, -1, axis=0) - wp
+    angles = np.arctan2(d[:, 1], d[:, 0])
+    return np.cos(angles), np.sin(angles), build_speed_up_table(wp)
+
+
+def load_track_tables(wp):
+    # share the tables between worker processes training on the same track
+    # the speed up table depends on the tuning as well as on the track
+    try:
+        hasher = hashlib.md5(usedforsecurity=False)
+    except TypeError:
+        # python < 3.9 has no usedforsecurity
+        hasher = hashlib.md5()
+    hasher.update(repr((_TRACK_TABLES_VERSION, DIRECTION_THRESHOLD, SPEED_UP_MIN_STEP,
+                        SPEED_UP_FUTURE_STEP, SPEED_UP_MIN_DISTANCE)).encode())
+    hasher.update(wp.tobytes())
+    key = hasher.hexdigest()[:16]
+    path = os.path.join(tempfile.gettempdir(), 'deepracer_wp_%s.npz' % key)
+    try:
+        with np.load(path) as data:
+            tables = data['c'], data['s'], data['t']
+        if all(len(table) == len(wp) for table in tables):
+            return tables
+    except Exception:
+        # the temp dir is shared, so anything unreadable there is just rebuilt
+        pass
+
+    tables = build_track_tables(wp)
+    # write to a private file first so other workers never read a partial file
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, c=tables[0], s=tables[1], t=tables[2])
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return tables
+
+
+# per-segment unit vectors and speed up table of the current track, keyed by id(waypoints).
+# kept as python lists, indexing them per step is cheaper than indexing numpy arrays
+_TRACK_CACHE = {}
+
+
+def get_track(waypoints):
+    key = id(waypoints)
+    cached = _TRACK_CACHE.get(key)
+    if cached is None or cached[0] is not waypoints:
+        tables = load_track_tables(np.asarray(waypoints, dtype=float))
+        _TRACK_CACHE.clear()
+        cached = _TRACK_CACHE[key] = (waypoints,) + tuple(table.tolist() for table in tables)
+    return cached[1:]
+
+
+def chk_exception(ret_reward, exception):
+    return LOWEST_REWARD if exception else ret_reward
+
+
+def chk_on_track(ret_reward, on_track):
+    return ret_reward if on_track else LOWEST_REWARD
+
+
+def chk_straight_line(ret_reward, abs_steering, speed):
+    if abs_steering < STRAIGHT_STEERING_THRESHOLD_1 and speed >= 2.8:
+        ret_reward = ret_reward * REINFORCE_FACTOR_2
+    elif abs_steering < STRAIGHT_STEERING_THRESHOLD_2 and speed > 2.2:
+        ret_reward = ret_reward * REINFORCE_FACTOR_1
+    return ret_reward
+
+
+def chk_direction(ret_reward, waypoints, closest_waypoints, heading):
+    ux, uy, _ = get_track(waypoints)
+    heading_rad = math.radians(heading)
+
+    # cosine of the angle between the heading and the track direction
+    dot = ux[closest_waypoints[0]] * math.cos(heading_rad) + uy[closest_waypoints[0]] * math.sin(heading_rad)
+
+    if dot < COS_DIRECTION_THRESHOLD:
+        ret_reward = ret_reward * PUNISH_FACTOR_3
+
+    return ret_reward
+
+
+def chk_steering(ret_reward, steering):
+    if abs(steering) > ABS_STEERING_THRESHOLD:
+        ret_reward = ret_reward * 0.9
+    return ret_reward
+
+
+def chk_steering_rate(ret_reward, speed, steering):
+    if speed > 2.5 - (0.4 * abs(steering)):
+        ret_reward = ret_reward * PUNISH_FACTOR_1
+    return ret_reward
+
+
+def chk_speed(ret_reward, speed):
+    if speed < 1.8:
+        ret_reward = ret_reward * PUNISH_FACTOR_4
+    elif speed > 2.2:
+        ret_reward = ret_reward * REINFORCE_FACTOR_4
+    return ret_reward
+
+
+def build_reward_table():
+    # reward for every (center distance, speed up, speed, left of center, progress) bucket
+    table = np.empty((4, 2, 3, 2, 2))
+    for distance_bucket, speed_up, speed_bucket, is_left_of_center, past_progress in np.ndindex(table.shape):
+        reward = DEFAULT_REWARD
+        if distance_bucket == 0:
+            reward *= REINFORCE_FACTOR_1
+        elif distance_bucket == 1:
+            reward *= PUNISH_FACTOR_1
+        elif distance_bucket == 2:
+            reward *= PUNISH_FACTOR_2
+        else:
+            reward = LOWEST_REWARD
+
+        # speed up on straights, slow down ahead of corners
+        if speed_up and speed_bucket == 2:
+            reward *= REINFORCE_FACTOR_4
+        elif not speed_up and speed_bucket == 0:
+            reward *= REINFORCE_FACTOR_1
+
+        # keep left
+        if is_left_of_center:
+            reward *= REINFORCE_FACTOR_1
+        else:
+            reward *= PUNISH_FACTOR_1
+
+        if past_progress:
+            reward *= REINFORCE_FACTOR_3
+
+        table[distance_bucket, speed_up, speed_bucket, is_left_of_center, past_progress] = reward
+    return table
+
+
+# flat tuple, indexing it from python is cheaper than indexing a 5-d ndarray
+_REWARD_TABLE = tuple(build_reward_table().ravel().tolist())
+
+
+def _compute_reward(marker_1: float, marker_2: float, marker_3: float, distance_from_center: float,
+                    is_left_of_center, speed: float, progress: float, speed_up) -> float:
+    if distance_from_center <= marker_1:
+        distance_bucket = 0
+    elif distance_from_center <= marker_2:
+        distance_bucket = 1
+    elif distance_from_center <= marker_3:
+        distance_bucket = 2
+    else:
+        distance_bucket = 3
+
+    if speed < 1.4:
+        speed_bucket = 0
+    elif speed > 2.25:
+        speed_bucket = 2
+    else:
+        speed_bucket = 1
+
+    # row-major offset into the (4, 2, 3, 2, 2) table
+    index = 24 * distance_bucket + 4 * speed_bucket
+    if speed_up:
+        index += 12
+    if is_left_of_center:
+        index += 2
+    if progress > PROGRESS_THRESHOLD:
+        index += 1
+    return _REWARD_TABLE[index]
+
+
 def reward_function(params):
     """
     params
@@ -31,159 +272,22 @@ def reward_function(params):
     }
     """
 
-    DEFAULT_REWARD = 1.0 # math.exp(-5 * distance_from_center)
-    LOWEST_REWARD = 1e-3
-    DIRECTION_THRESHOLD = 8.0
-    ABS_STEERING_THRESHOLD = 20.0
-    PROGRESS_THRESHOLD = 75
-    REINFORCE_FACTOR_1 = 1.2
-    REINFORCE_FACTOR_2 = 1.5
-    REINFORCE_FACTOR_3 = 1.3
-    REINFORCE_FACTOR_4 = 1.28
-    PUNISH_FACTOR_1 = 0.8
-    PUNISH_FACTOR_2 = 0.5
-    PUNISH_FACTOR_3 = 0.6
-    PUNISH_FACTOR_4 = 0.73
-
     # parameters
-    track_width = params['track_width']
-    distance_from_center = params['distance_from_center']
-    is_left_of_center = params['is_left_of_center']
-    all_wheels_on_track = params['all_wheels_on_track']
-    abs_steering = abs(params['steering_angle'])
-    speed = params['speed']
-    waypoints = params['waypoints']
-    closest_waypoints = params['closest_waypoints'] 
-    heading = params['heading']
-    progress = params['progress']
-    is_crashed = params['is_crashed']
-    is_reversed = params['is_reversed']
-    is_offtrack = params['is_offtrack']
-    steps = params['steps']
-
-    # reward class
-    class RewardClass(object):
-        def chk_exception(self, ret_reward, exception):
-            if exception:
-                return LOWEST_REWARD
-            return DEFAULT_REWARD
-
-        def chk_on_track(self, ret_reward, on_track):
-            if on_track:
-                return DEFAULT_REWARD
-            return LOWEST_REWARD
-        
-        def chk_center_distance(self, ret_reward, width, distance):
-            marker_1 = 0.1 * width
-            marker_2 = 0.25 * width
-            marker_3 = 0.5 * width
-
-            if distance <= marker_1:
-                ret_reward = ret_reward * REINFORCE_FACTOR_1
-            elif distance <= marker_2:
-                ret_reward = ret_reward * PUNISH_FACTOR_1
-            elif distance <= marker_3:
-                ret_reward = ret_reward * PUNISH_FACTOR_2
-            else:
-                ret_reward = LOWEST_REWARD
-            return ret_reward
-        
-        def chk_straight_line(self, ret_reward, abs_steering, speed):
-            if abs_steering < 0.1 and speed >= 2.8:
-                ret_reward = ret_reward * REINFORCE_FACTOR_2
-            elif abs_steering < 0.2 and speed > 2.2:
-                ret_reward = ret_reward * REINFORCE_FACTOR_1
-            return ret_reward
-        
-        def is_speed_up(self, ret_reward, waypoints, closest_waypoints, speed, min_step=3, future_step=8):
-            speed_up = False
-            next_waypoint = waypoints[closest_waypoints[1]]
-            prev_waypoint = waypoints[closest_waypoints[0]]
-            further_waypoint = waypoints[min(len(waypoints) - 1, closest_waypoints[1] + future_step)]
-
-            direction_degree = math.degrees(math.atan2(prev_waypoint[1] - next_waypoint[1], 
-                                                        prev_waypoint[0] - next_waypoint[0]))
-            future_degree = math.degrees(math.atan2(prev_waypoint[1] - further_waypoint[1], 
-                                                 prev_waypoint[0]-further_waypoint[0]))
-
-            difference = abs(direction_degree - future_degree)
-            
-            distance = np.linalg.norm([next_waypoint[0] - further_waypoint[0],
-                                      next_waypoint[1] - further_waypoint[1]]) 
-            
-            diff = difference if difference < 180 else 360 - difference
-
-            if difference < DIRECTION_THRESHOLD:
-                speed_up = True
-            else:
-                if distance < 1.1:
-                    speed_up = False
-                else:
-                    further_waypoint = waypoints[min(len(waypoints) - 1, closest_waypoints[1] + min_step)]
-                    future_degree = math.degrees(math.atan2(prev_waypoint[1] - further_waypoint[1], 
-                                                            prev_waypoint[0]-further_waypoint[0]))
-                    difference = abs(direction_degree - future_degree)
-                    diff = difference if difference < 180 else 360 - difference
-                    if diff < DIRECTION_THRESHOLD:
-                        speed_up = True
-            if speed_up and speed > 2.25:
-                ret_reward = ret_reward * REINFORCE_FACTOR_4
-            elif not speed_up and speed < 1.4:
-                ret_reward = ret_reward * REINFORCE_FACTOR_1
-            return ret_reward
-        
-        def chk_direction(self, ret_reward, waypoints, closest_waypoints, heading):
-            next_waypoint = waypoints[closest_waypoints[1]]
-            prev_waypoint = waypoints[closest_waypoints[0]]
-
-            direction_degree = math.degrees(math.atan2(next_waypoint[1] - prev_waypoint[1], next_waypoint[0] - prev_waypoint[0]))
-
-            difference = abs(direction_degree - heading)
-
-            if difference > DIRECTION_THRESHOLD:
-                ret_reward = ret_reward * PUNISH_FACTOR_3
-
-            return ret_reward
-        
-        def chk_steering(self, ret_reward, steering):
-            if abs(steering) > ABS_STEERING_THRESHOLD:
-                ret_reward = ret_reward * 0.9
-            return ret_reward
-
-        def chk_steering_rate(self, ret_reward, speed, steering):
-            if speed > 2.5 - (0.4 * abs(steering)):
-                ret_reward = ret_reward * PUNISH_FACTOR_1
-            return ret_reward
-        
-        def chk_is_left_of_center(self, ret_reward, is_left_of_center):
-            if is_left_of_center:
-                ret_reward = ret_reward * REINFORCE_FACTOR_1
-            else:
-                ret_reward = ret_reward * PUNISH_FACTOR_1
-            return ret_reward
-        
-        def chk_progress(self, ret_reward, progress):
-            if progress > PROGRESS_THRESHOLD:
-                ret_reward = ret_reward * REINFORCE_FACTOR_3
-            return ret_reward
-        
-        def chk_speed(self, ret_reward, speed):
-            if speed < 1.8:
-                ret_reward = ret_reward * PUNISH_FACTOR_4
-            elif speed > 2.2:
-                ret_reward = ret_reward * REINFORCE_FACTOR_4
-            return ret_reward
-        
-    r = RewardClass()
-    reward = DEFAULT_REWARD
-    reward = r.chk_on_track(reward, all_wheels_on_track)
-    reward = r.chk_exception(reward, is_offtrack)
-    reward = r.chk_exception(reward, is_crashed)
-    reward = r.chk_exception(reward, is_reversed)
-    reward = r.chk_center_distance(reward, track_width, distance_from_center)
-    reward = r.is_speed_up(reward, waypoints, closest_waypoints, speed)
-    reward = r.chk_is_left_of_center(reward, is_left_of_center)
-    reward = r.chk_progress(reward, progress)
-    # reward = r.chk_speed(reward, speed)
+    (track_width, distance_from_center, is_left_of_center, all_wheels_on_track, speed,
+     waypoints, closest_waypoints, progress, is_crashed, is_reversed, is_offtrack) = _get_params(params)
+
+    if is_offtrack or is_crashed or is_reversed or not all_wheels_on_track:
+        return float(LOWEST_REWARD)
+
+    # distance from center
+    markers = _MARKERS.get(track_width)
+    if markers is None:
+        markers = _MARKERS.setdefault(track_width, (0.1 * track_width, 0.25 * track_width, 0.5 * track_width))
+    marker_1, marker_2, marker_3 = markers
+    speed_up = get_track(waypoints)[2][closest_waypoints[0]]
+
+    reward = _compute_reward(marker_1, marker_2, marker_3, distance_from_center, is_left_of_center,
+                             speed, progress, speed_up)
+    # reward = chk_speed(reward, speed)
 
     return float(reward)
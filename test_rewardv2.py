@@ -0,0 +1,82 @@
+import math
+
+import numpy as np
+
+import rewardv2
+
+
+def baseline_is_speed_up(waypoints, closest_waypoints, min_step=3, future_step=8):
+    # the original per-step is_speed_up predicate, with the 180 degree wrap fixed
+    def wrap(difference):
+        return abs(((difference + 180) % 360) - 180)
+
+    next_waypoint = waypoints[closest_waypoints[1]]
+    prev_waypoint = waypoints[closest_waypoints[0]]
+    further_waypoint = waypoints[min(len(waypoints) - 1, closest_waypoints[1] + future_step)]
+
+    direction_degree = math.degrees(math.atan2(prev_waypoint[1] - next_waypoint[1],
+                                               prev_waypoint[0] - next_waypoint[0]))
+    future_degree = math.degrees(math.atan2(prev_waypoint[1] - further_waypoint[1],
+                                            prev_waypoint[0] - further_waypoint[0]))
+    if wrap(direction_degree - future_degree) < rewardv2.DIRECTION_THRESHOLD:
+        return True
+
+    distance = math.hypot(next_waypoint[0] - further_waypoint[0], next_waypoint[1] - further_waypoint[1])
+    if distance < 1.1:
+        return False
+
+    further_waypoint = waypoints[min(len(waypoints) - 1, closest_waypoints[1] + min_step)]
+    future_degree = math.degrees(math.atan2(prev_waypoint[1] - further_waypoint[1],
+                                            prev_waypoint[0] - further_waypoint[0]))
+    return wrap(direction_degree - future_degree) < rewardv2.DIRECTION_THRESHOLD
+
+
+def oval(n, closed=True):
+    # DeepRacer tracks repeat the first waypoint at the end
+    m = n - 1 if closed else n
+    points = [(5 * math.cos(2 * math.pi * i / m), 3 * math.sin(2 * math.pi * i / m)) for i in range(m)]
+    return points + [points[0]] if closed else points
+
+
+def assert_matches_baseline(waypoints):
+    table = rewardv2.build_speed_up_table(np.asarray(waypoints, dtype=float))
+    n = len(waypoints)
+    expected = [baseline_is_speed_up(waypoints, [i, (i + 1) % n]) for i in range(n)]
+    assert table.tolist() == expected
+
+
+def test_speed_up_table_matches_baseline_on_closed_track():
+    assert_matches_baseline(oval(120))
+    assert_matches_baseline(oval(60))
+
+
+def test_speed_up_table_matches_baseline_on_open_track():
+    assert_matches_baseline(oval(90, closed=False))
+    assert_matches_baseline([(0.3 * i, 0.0) for i in range(40)])
+
+
+def test_shared_track_tables_survive_corrupt_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(rewardv2.tempfile, 'tempdir', str(tmp_path))
+    waypoints = oval(120)
+    expected = rewardv2.build_speed_up_table(np.asarray(waypoints, dtype=float)).tolist()
+
+    rewardv2._TRACK_CACHE.clear()
+    assert rewardv2.get_track(waypoints)[2] == expected
+    (path,) = tmp_path.glob('deepracer_wp_*.npz')
+
+    path.write_bytes(b'PK\x03\x04garbage')
+    rewardv2._TRACK_CACHE.clear()
+    assert rewardv2.get_track(waypoints)[2] == expected
+
+
+def test_shared_track_tables_ignore_wrong_length(tmp_path, monkeypatch):
+    monkeypatch.setattr(rewardv2.tempfile, 'tempdir', str(tmp_path))
+    waypoints = oval(120)
+
+    rewardv2._TRACK_CACHE.clear()
+    rewardv2.get_track(waypoints)
+    (path,) = tmp_path.glob('deepracer_wp_*.npz')
+
+    np.savez(str(path), c=np.zeros(3), s=np.zeros(3), t=np.zeros(3, dtype=bool))
+    rewardv2._TRACK_CACHE.clear()
+    assert len(rewardv2.get_track(waypoints)[2]) == len(waypoints)